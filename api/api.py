@@ -4,31 +4,36 @@ import sys
 import logging
 import os
 import json
+import errno
+import ctypes
+import hashlib
 import asyncio
+import threading
 import time
 import re
-import uuid
 import secrets
-from typing import Union, List, Optional, Dict, Any
+import itertools
+import functools
+import math
+from collections import OrderedDict
+from contextvars import ContextVar, copy_context
+from typing import Annotated, Union, List, Optional, Dict, Any, Tuple, Type, TypeVar
 from datetime import datetime, timezone
 
+import orjson
+
 # =============================================================================
 # Service Start Time (for uptime calculation)
 # =============================================================================
 SERVICE_START_TIME = time.time()
 SERVICE_VERSION = "1.0.0"
 
-from fastapi import Request, FastAPI, HTTPException, Security, Depends
-from fastapi.security.api_key import APIKeyHeader
+from fastapi import Request, FastAPI, HTTPException, Depends
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_413_REQUEST_ENTITY_TOO_LARGE, HTTP_504_GATEWAY_TIMEOUT, HTTP_429_TOO_MANY_REQUESTS
-from starlette.middleware.base import BaseHTTPMiddleware
-from pydantic import BaseModel, Field, validator
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
-from slowapi.middleware import SlowAPIMiddleware
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from pydantic import BaseModel, ConfigDict, Field, StringConstraints, ValidationError, field_validator
 
 
 # =============================================================================
@@ -82,6 +87,10 @@ class SensitiveDataFilter(logging.Filter):
         (re.compile(r'aws_access_key["\']?\s*[:=]\s*["\']?[\w]+', re.IGNORECASE), 'aws_access_key=[REDACTED]'),
     ]
     
+    # Every pattern above contains one of these (casefolded) keywords, so text
+    # without any of them can skip the regexes entirely. Keep them in sync.
+    SENSITIVE_KEYWORDS = ("key", "auth", "bearer", "pass", "secret", "token")
+    
     def __init__(self, mask_ips: bool = False):
         """
         Initialize the filter.
@@ -96,12 +105,17 @@ class SensitiveDataFilter(logging.Filter):
     
     def filter(self, record: logging.LogRecord) -> bool:
         """Filter and redact sensitive data from log record."""
+        # Skip records this filter already redacted (e.g. attached to several handlers)
+        if getattr(record, '_redacted_by', None) is self:
+            return True
+        
         # Redact message
         if hasattr(record, 'msg') and isinstance(record.msg, str):
             record.msg = self._redact_sensitive(record.msg)
         
-        # Redact args if present
-        if record.args:
+        # Redact args if present; a keyword check over the string args first
+        # avoids rebuilding the args for the common case of nothing to redact
+        if record.args and (self.mask_ips or self._args_contain_keyword(record.args)):
             if isinstance(record.args, dict):
                 record.args = {k: self._redact_sensitive(str(v)) if isinstance(v, str) else v
                               for k, v in record.args.items()}
@@ -109,18 +123,40 @@ class SensitiveDataFilter(logging.Filter):
                 record.args = tuple(self._redact_sensitive(str(arg)) if isinstance(arg, str) else arg
                                    for arg in record.args)
         
+        record._redacted_by = self
         return True
     
     def _redact_sensitive(self, text: str) -> str:
         """Redact sensitive patterns from text."""
-        for pattern, replacement in self.SENSITIVE_PATTERNS:
-            text = pattern.sub(replacement, text)
+        # Cheap substring prefilter: most log lines contain no keyword at all
+        if self._contains_keyword(text):
+            text = self._redact_patterns(text)
         
         # Optionally mask IP addresses (partial masking for debugging)
         if self.mask_ips:
             text = self.ip_pattern.sub(r'\1.xxx.xxx.\2', text)
         
         return text
+    
+    def _args_contain_keyword(self, args) -> bool:
+        """Check whether any string in record args (tuple or dict) contains a keyword."""
+        values = args.values() if isinstance(args, dict) else args
+        return any(isinstance(value, str) and self._contains_keyword(value) for value in values)
+    
+    def _contains_keyword(self, text: str) -> bool:
+        """Check whether text contains any of SENSITIVE_KEYWORDS."""
+        # casefold() rather than lower(): re.IGNORECASE also matches 'ſ' (U+017F)
+        # for 's', which lower() leaves unchanged
+        folded = text.casefold()
+        return any(keyword in folded for keyword in self.SENSITIVE_KEYWORDS)
+    
+    def _redact_patterns(self, text: str) -> str:
+        """Replace every SENSITIVE_PATTERNS match in text."""
+        # Applied one pattern at a time, in order: where matches overlap, a
+        # later pattern still sees (and redacts) what an earlier one left
+        for pattern, replacement in self.SENSITIVE_PATTERNS:
+            text = pattern.sub(replacement, text)
+        return text
 
 
 class JSONFormatter(logging.Formatter):
@@ -131,14 +167,19 @@ class JSONFormatter(logging.Formatter):
     by log aggregation systems (ELK, Splunk, etc.)
     """
     
+    # (epoch second, formatted "YYYY-MM-DDTHH:MM:SS") of the last record;
+    # records logged within the same second reuse the formatted prefix
+    _ts_cache = (-1, "")
+    
     def format(self, record: logging.LogRecord) -> str:
         """Format log record as JSON."""
         # Base log data
         log_data = {
-            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "timestamp": self._format_timestamp(record),
             "level": record.levelname,
             "logger": record.name,
-            "message": record.getMessage(),
+            # Plain string messages need no %-formatting (most log calls)
+            "message": record.msg if not record.args and isinstance(record.msg, str) else record.getMessage(),
         }
         
         # Add request context if available
@@ -163,7 +204,20 @@ class JSONFormatter(logging.Formatter):
         if hasattr(record, 'extra_fields') and isinstance(record.extra_fields, dict):
             log_data.update(record.extra_fields)
         
-        return json.dumps(log_data, default=str)
+        try:
+            return orjson.dumps(log_data, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+        except orjson.JSONEncodeError:
+            # e.g. integers beyond 64 bits, which orjson refuses
+            return json.dumps(log_data, default=str)
+    
+    def _format_timestamp(self, record: logging.LogRecord) -> str:
+        """Format the record creation time as ISO 8601 UTC with milliseconds."""
+        second = int(record.created)
+        cached_second, prefix = JSONFormatter._ts_cache
+        if second != cached_second:
+            prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+            JSONFormatter._ts_cache = (second, prefix)
+        return f"{prefix}.{int(record.msecs):03d}Z"
 
 
 class SecureLoggerAdapter(logging.LoggerAdapter):
@@ -226,6 +280,16 @@ logger = setup_secure_logging()
 # =============================================================================
 REQUEST_TIMEOUT_SECONDS = int(os.getenv("REQUEST_TIMEOUT_SECONDS", "30"))  # Maximum time for a request to complete
 SLOW_REQUEST_THRESHOLD = int(os.getenv("SLOW_REQUEST_THRESHOLD", "5"))     # Log warning for requests taking longer than this
+SLOW_REQUEST_THRESHOLD_NS = SLOW_REQUEST_THRESHOLD * 1_000_000_000
+
+# Maximum number of worker threads sending /batch events to the Wazuh queue
+# at once. A send blocks while the queue is full, and a thread keeps its slot
+# until the send returns, even if the request has already timed out, so the
+# bound keeps threads free for other work; tune it to the queue's capacity.
+BATCH_SEND_CONCURRENCY = int(os.getenv("BATCH_SEND_CONCURRENCY", "8"))
+# Same bound for /ingest events that have to wait for room in a full queue
+# (first tried without blocking, see send_msg_json_async)
+INGEST_SEND_CONCURRENCY = int(os.getenv("INGEST_SEND_CONCURRENCY", "8"))
 
 # =============================================================================
 # Payload Size Limits (DoS Protection)
@@ -237,10 +301,16 @@ MAX_CONTENT_LENGTH_DEFAULT = 10 * 1024 * 1024  # 10MB
 MAX_CONTENT_LENGTH_INGEST = 1 * 1024 * 1024    # 1MB for single log ingestion
 MAX_CONTENT_LENGTH_BATCH = 10 * 1024 * 1024    # 10MB for batch ingestion
 
-try:
-    import boto3
-except ImportError:
-    logger.warning('boto3 module is not installed, but proceeding as it is not strictly required for ingestion.')
+# (limit, endpoint type) by exact request path; other paths get the default
+PAYLOAD_LIMITS_BY_PATH = {
+    "/": (MAX_CONTENT_LENGTH_INGEST, "ingest"),
+    "/ingest": (MAX_CONTENT_LENGTH_INGEST, "ingest"),
+    "/batch": (MAX_CONTENT_LENGTH_BATCH, "batch"),
+}
+DEFAULT_PAYLOAD_LIMIT = (MAX_CONTENT_LENGTH_DEFAULT, "default")
+
+# Methods none of the endpoints read a body for; the size check is skipped
+BODYLESS_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "DELETE"})
 
 # Security: API Key Authentication - MANDATORY
 API_KEY_NAME = "X-API-Key"
@@ -301,6 +371,10 @@ if not API_KEY:
         "  3. Environment variable API_KEY"
     )
 
+# Presented keys are hashed and compared against this digest, so the
+# constant-time comparison always covers 32 bytes whatever the key length.
+_API_KEY_DIGEST = hashlib.sha256(API_KEY.encode()).digest()
+
 logger.info("API key authentication enabled successfully.")
 
 # =============================================================================
@@ -383,14 +457,65 @@ def check_certificate_validity():
 # Run certificate check at module load time
 check_certificate_validity()
 
-# Initialize Rate Limiter
-# Uses get_remote_address which relies on request.client.host
-# Since we use uvicorn --proxy-headers, this will correctly identify the real client IP
-limiter = Limiter(key_func=get_remote_address)
+
+# =============================================================================
+# Rate Limiting
+# =============================================================================
+class TokenBucketLimiter:
+    """
+    Per-client token bucket rate limiter with bounded memory.
+    
+    Each key only stores (tokens, last refill time). Buckets are kept in
+    least-recently-used order and the oldest are evicted beyond max_keys,
+    so memory stays bounded however many distinct clients are seen.
+    
+    Not thread-safe; it is only used from the event loop.
+    """
+    
+    def __init__(self, capacity: int, per_seconds: float, max_keys: int = 100_000):
+        """
+        Initialize the limiter.
+        
+        Args:
+            capacity: Requests allowed in a burst (and per period)
+            per_seconds: Period over which capacity tokens are refilled
+            max_keys: Maximum number of client buckets kept in memory
+        """
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+    
+    def check(self, key: str) -> float:
+        """
+        Take a token from the bucket for key.
+        
+        Returns:
+            0.0 if the request is allowed, otherwise the number of seconds
+            until a token becomes available.
+        """
+        now = time.monotonic()
+        buckets = self._buckets
+        tokens, last = buckets.get(key, (self.capacity, now))
+        tokens = min(self.capacity, tokens + (now - last) * self.rate)
+        
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        buckets[key] = (tokens, now)
+        buckets.move_to_end(key)
+        if len(buckets) > self.max_keys:
+            buckets.popitem(last=False)
+        
+        return 0.0 if allowed else (1 - tokens) / self.rate
+
+
+# Batch ingestion: 100 requests per minute per client IP.
+# Keyed on request.client.host; since we use uvicorn --proxy-headers, this
+# correctly identifies the real client IP.
+batch_limiter = TokenBucketLimiter(capacity=100, per_seconds=60)
 
 app = FastAPI(title="Wazuh Ingestion API", version="1.0.0")
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 
 # =============================================================================
@@ -400,105 +525,86 @@ app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 class IngestEvent(BaseModel):
     """Model for a single log event to be ingested."""
     
+    model_config = ConfigDict(
+        # Allow extra fields to be ignored (for forward compatibility)
+        extra='ignore',
+        # Generate JSON schema
+        json_schema_extra={
+            "example": {
+                "timestamp": "2024-01-15T10:30:00Z",
+                "source": "web-server-01",
+                "message": "Request processed successfully",
+                "level": "info",
+                "tags": ["http", "request"],
+                "metadata": {"status_code": 200}
+            }
+        }
+    )
+    
     # Required fields
+    # Constraints are declared on the fields so pydantic-core enforces them
+    # without calling back into Python validators.
     timestamp: str = Field(
         ...,
+        min_length=10,
         description="Event timestamp in ISO 8601 format",
-        example="2024-01-15T10:30:00Z"
+        examples=["2024-01-15T10:30:00Z"]
     )
     source: str = Field(
         ...,
         min_length=1,
         max_length=256,
         description="Source of the log event",
-        example="application-server-01"
+        examples=["application-server-01"]
     )
     message: str = Field(
         ...,
         min_length=1,
         max_length=65536,
         description="Log message content",
-        example="User login successful"
+        examples=["User login successful"]
     )
     
     # Optional fields with defaults
     level: Optional[str] = Field(
         default="info",
         description="Log level (debug, info, warning, error, critical)",
-        example="info"
+        examples=["info"]
     )
-    tags: Optional[List[str]] = Field(
-        default=[],
+    # An immutable default can be shared by all events instead of being
+    # copied for each one, as pydantic does for mutable defaults.
+    tags: Optional[Tuple[Annotated[str, StringConstraints(max_length=64)], ...]] = Field(
+        default=(),
         description="Optional tags for categorization",
-        example=["auth", "security"]
+        examples=[["auth", "security"]]
     )
     metadata: Optional[Dict[str, Any]] = Field(
-        default={},
+        default_factory=dict,
         description="Additional metadata as key-value pairs",
-        example={"user_id": "12345", "ip": "192.168.1.1"}
+        examples=[{"user_id": "12345", "ip": "192.168.1.1"}]
     )
     decoder: Optional[str] = Field(
         default=None,
         max_length=128,
         description="Optional decoder name for Wazuh",
-        example="custom-decoder"
+        examples=["custom-decoder"]
     )
     
     # Validators
-    @validator('level')
+    @field_validator('level')
+    @classmethod
     def validate_level(cls, v):
         allowed_levels = ['debug', 'info', 'warning', 'error', 'critical']
         if v and v.lower() not in allowed_levels:
             raise ValueError(f"Level must be one of: {', '.join(allowed_levels)}")
         return v.lower() if v else 'info'
-    
-    @validator('timestamp')
-    def validate_timestamp(cls, v):
-        # Basic timestamp validation
-        if not v or len(v) < 10:
-            raise ValueError("Invalid timestamp format")
-        return v
-    
-    @validator('tags', pre=True, always=True)
-    def validate_tags(cls, v):
-        if v is None:
-            return []
-        if not isinstance(v, list):
-            raise ValueError("Tags must be a list")
-        # Validate each tag
-        for tag in v:
-            if not isinstance(tag, str) or len(tag) > 64:
-                raise ValueError("Each tag must be a string with max 64 characters")
-        return v
-    
-    class Config:
-        # Allow extra fields to be ignored (for forward compatibility)
-        extra = 'ignore'
-        # Generate JSON schema
-        schema_extra = {
-            "example": {
-                "timestamp": "2024-01-15T10:30:00Z",
-                "source": "web-server-01",
-                "message": "Request processed successfully",
-                "level": "info",
-                "tags": ["http", "request"],
-                "metadata": {"status_code": 200}
-            }
-        }
 
 
 class BatchIngestRequest(BaseModel):
     """Model for batch log ingestion."""
     
-    events: List[IngestEvent] = Field(
-        ...,
-        min_items=1,
-        max_items=1000,
-        description="List of events to ingest (1-1000 events)"
-    )
-    
-    class Config:
-        schema_extra = {
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {
                 "events": [
                     {
@@ -514,42 +620,100 @@ class BatchIngestRequest(BaseModel):
                 ]
             }
         }
+    )
+    
+    events: List[IngestEvent] = Field(
+        ...,
+        min_length=1,
+        max_length=1000,
+        description="List of events to ingest (1-1000 events)"
+    )
 
 
 # =============================================================================
 # Request ID Middleware (Request Tracking & Correlation)
 # =============================================================================
-class RequestIDMiddleware(BaseHTTPMiddleware):
+# Random per-process prefix keeps IDs unique across workers and restarts;
+# the counter makes them unique within the process.
+_REQUEST_ID_PREFIX = secrets.token_hex(4)
+_request_counter = itertools.count(1)
+
+# Reported when no ID was assigned (e.g. errors raised outside the middleware)
+UNKNOWN_REQUEST_ID = "unknown"
+
+# Raw ASGI header names and values used by the middleware below. ASGI
+# requires lowercase header names, so they can be compared byte-for-byte.
+_HDR_CONTENT_TYPE_JSON = (b"content-type", b"application/json")
+_HDR_CONTENT_LENGTH = b"content-length"
+_HDR_REQUEST_ID = b"x-request-id"
+_HDR_REQUEST_DURATION = b"x-request-duration"
+_HDR_API_KEY = API_KEY_NAME.lower().encode()
+
+# ID of the request being handled by the current task
+_current_request_id: ContextVar[str] = ContextVar("request_id", default=UNKNOWN_REQUEST_ID)
+
+
+class RequestIDMiddleware:
     """
     Middleware to generate and track unique request IDs.
     
-    Each request gets a unique UUID that is:
-    - Stored in request.state.request_id
+    Each request gets a unique ID that is:
+    - Available anywhere in the request via get_request_id()
     - Included in all log entries
     - Returned in X-Request-ID response header
     
     This enables request correlation across logs and debugging.
+    
+    Implemented as plain ASGI middleware so requests are not routed through
+    the extra task and message queues BaseHTTPMiddleware introduces.
     """
     
-    async def dispatch(self, request: Request, call_next):
-        # Generate unique request ID
-        request_id = str(uuid.uuid4())
+    def __init__(self, app: ASGIApp):
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
         
-        # Store in request state for access by other middleware/handlers
-        request.state.request_id = request_id
+        # Generate unique request ID
+        request_id = new_request_id()
         
-        # Process request
-        response = await call_next(request)
+        # Make it available to handlers and logging in this request's context
+        token = _current_request_id.set(request_id)
+        request_id_header = (_HDR_REQUEST_ID, request_id.encode())
         
-        # Add request ID to response headers
-        response.headers["X-Request-ID"] = request_id
+        async def send_with_request_id(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                # Replace any X-Request-ID already set by an error handler
+                headers = [
+                    header for header in message.get("headers", ())
+                    if header[0] != _HDR_REQUEST_ID
+                ]
+                headers.append(request_id_header)
+                message["headers"] = headers
+            await send(message)
         
-        return response
+        # Not reset when the app raises, so the server error handler outside
+        # this middleware still reports the ID; each request runs in its own
+        # task, so the value cannot leak into another request.
+        await self.app(scope, receive, send_with_request_id)
+        _current_request_id.reset(token)
 
 
-def get_request_id(request: Request) -> str:
-    """Get request ID from request state, or generate a new one."""
-    return getattr(request.state, 'request_id', str(uuid.uuid4()))
+def new_request_id() -> str:
+    """
+    Generate a request ID unique within this deployment.
+    
+    IDs are a random per-process prefix plus a counter ("3f9a1c2e-1a"), which
+    avoids reading from the OS random source on every request.
+    """
+    return f"{_REQUEST_ID_PREFIX}-{next(_request_counter):x}"
+
+
+def get_request_id() -> str:
+    """Get the current request's ID, or "unknown" if none was assigned."""
+    return _current_request_id.get()
 
 
 def log_with_context(
@@ -570,7 +734,7 @@ def log_with_context(
     extra = {}
     
     if request:
-        extra['request_id'] = get_request_id(request)
+        extra['request_id'] = get_request_id()
         extra['client_ip'] = request.client.host if request.client else "unknown"
         extra['method'] = request.method
         extra['endpoint'] = request.url.path
@@ -581,10 +745,61 @@ def log_with_context(
     log_method(message, extra=extra)
 
 
+# Error bodies that only differ by request ID are serialized once at import;
+# responses substitute the ID for the placeholder. Request IDs never contain
+# characters that would need escaping in JSON.
+_REQUEST_ID_PLACEHOLDER = b"__RID__"
+
+
+def _error_body_template(error: str, message: str) -> bytes:
+    """Serialize a standard error body with a request ID placeholder."""
+    return orjson.dumps({
+        "error": error,
+        "message": message,
+        "request_id": _REQUEST_ID_PLACEHOLDER.decode()
+    })
+
+
+_INVALID_CONTENT_LENGTH_BODY = _error_body_template("Bad Request", "Invalid Content-Length header")
+_PAYLOAD_TOO_LARGE_BODY = _error_body_template("Payload Too Large", "Request body exceeds maximum allowed size")
+_GATEWAY_TIMEOUT_BODY = _error_body_template("Gateway Timeout", "Request processing time exceeded")
+_AUTHENTICATION_REQUIRED_BODY = _error_body_template("Unauthorized", "Authentication required")
+_INVALID_CREDENTIALS_BODY = _error_body_template("Unauthorized", "Invalid credentials")
+_INTERNAL_ERROR_BODY = _error_body_template(
+    "Internal Server Error",
+    "An unexpected error occurred. Please try again later."
+)
+
+
+def render_error_body(template: bytes, request_id: str) -> bytes:
+    """Fill the request ID into a pre-serialized error body."""
+    return template.replace(_REQUEST_ID_PLACEHOLDER, request_id.encode())
+
+
+async def send_json_error(send: Send, status_code: int, template: bytes, request_id: str) -> None:
+    """
+    Send a pre-serialized JSON error response directly over ASGI.
+    
+    Used by the middleware reject paths, which run outside FastAPI's
+    exception handlers and do not need a Response object.
+    """
+    body = render_error_body(template, request_id)
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [
+            _HDR_CONTENT_TYPE_JSON,
+            (_HDR_CONTENT_LENGTH, b"%d" % len(body)),
+            (_HDR_REQUEST_ID, request_id.encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
 # =============================================================================
 # Request Timeout Middleware (Slow Client Attack Protection)
 # =============================================================================
-class RequestTimeoutMiddleware(BaseHTTPMiddleware):
+class RequestTimeoutMiddleware:
     """
     Middleware to enforce request timeouts and track slow requests.
     
@@ -596,64 +811,76 @@ class RequestTimeoutMiddleware(BaseHTTPMiddleware):
     - SLOW_REQUEST_THRESHOLD: Log warning for requests taking longer than this (default: 5s)
     """
     
-    async def dispatch(self, request: Request, call_next):
-        start_time = time.time()
-        request_id = get_request_id(request)
-        client_ip = request.client.host if request.client else "unknown"
+    def __init__(self, app: ASGIApp):
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        start_ns = time.monotonic_ns()
+        response_started = False
+        
+        async def send_with_duration(message: Message) -> None:
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+                # Add timing header to response, e.g. b"0.004s"
+                duration_ms = (time.monotonic_ns() - start_ns) // 1_000_000
+                message["headers"] = [
+                    *message.get("headers", ()),
+                    (_HDR_REQUEST_DURATION, b"%d.%03ds" % divmod(duration_ms, 1000)),
+                ]
+            await send(message)
         
         try:
             # Wrap the request processing with a timeout
-            response = await asyncio.wait_for(
-                call_next(request),
+            await asyncio.wait_for(
+                self.app(scope, receive, send_with_duration),
                 timeout=REQUEST_TIMEOUT_SECONDS
             )
-            
-            # Calculate request duration
-            duration = time.time() - start_time
-            duration_ms = int(duration * 1000)
-            
-            # Log slow requests with structured context
-            if duration > SLOW_REQUEST_THRESHOLD:
-                log_with_context(
-                    "warning",
-                    "Slow request detected",
-                    request,
-                    duration_ms=duration_ms,
-                    threshold_ms=SLOW_REQUEST_THRESHOLD * 1000
-                )
-            
-            # Add timing header to response
-            response.headers["X-Request-Duration"] = f"{duration:.3f}s"
-            
-            return response
-            
         except asyncio.TimeoutError:
-            duration = time.time() - start_time
-            duration_ms = int(duration * 1000)
+            duration_ns = time.monotonic_ns() - start_ns
+            request = Request(scope)
             
             log_with_context(
                 "error",
                 "Request timeout exceeded",
                 request,
-                duration_ms=duration_ms,
+                duration_ms=duration_ns // 1_000_000,
                 timeout_seconds=REQUEST_TIMEOUT_SECONDS
             )
             
-            return JSONResponse(
-                status_code=HTTP_504_GATEWAY_TIMEOUT,
-                content={
-                    "error": "Gateway Timeout",
-                    "message": "Request processing time exceeded",
-                    "request_id": request_id
-                },
-                headers={"X-Request-ID": request_id}
+            # Headers already went out; nothing sensible can be sent anymore
+            if response_started:
+                return
+            
+            request_id = get_request_id()
+            await send_json_error(
+                send,
+                HTTP_504_GATEWAY_TIMEOUT,
+                _GATEWAY_TIMEOUT_BODY,
+                request_id
+            )
+            return
+        
+        # Log slow requests with structured context
+        duration_ns = time.monotonic_ns() - start_ns
+        if duration_ns > SLOW_REQUEST_THRESHOLD_NS:
+            log_with_context(
+                "warning",
+                "Slow request detected",
+                Request(scope),
+                duration_ms=duration_ns // 1_000_000,
+                threshold_ms=SLOW_REQUEST_THRESHOLD * 1000
             )
 
 
 # =============================================================================
 # Payload Size Limit Middleware (DoS Protection)
 # =============================================================================
-class PayloadSizeLimitMiddleware(BaseHTTPMiddleware):
+class PayloadSizeLimitMiddleware:
     """
     Middleware to enforce payload size limits.
     
@@ -664,77 +891,171 @@ class PayloadSizeLimitMiddleware(BaseHTTPMiddleware):
     - /batch endpoints: 10MB (for batch log ingestion)
     - / (ingest) endpoint: 1MB (for single log ingestion)
     - Other endpoints: 10MB (default)
+    
+    Only the Content-Length header is inspected, so the check reads the raw
+    ASGI headers and builds no Request object unless the request is rejected.
     """
     
-    async def dispatch(self, request: Request, call_next):
+    def __init__(self, app: ASGIApp):
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] in BODYLESS_METHODS:
+            await self.app(scope, receive, send)
+            return
+        
         # Get Content-Length header
-        content_length = request.headers.get("content-length")
-        request_id = get_request_id(request)
+        content_length = None
+        for name, value in scope["headers"]:
+            if name == _HDR_CONTENT_LENGTH:
+                content_length = value
+                break
         
         if content_length:
             try:
                 content_length = int(content_length)
             except ValueError:
                 # Invalid Content-Length header
-                log_with_context(
-                    "warning",
-                    "Invalid Content-Length header received",
-                    request
-                )
-                return JSONResponse(
-                    status_code=400,
-                    content={
-                        "error": "Bad Request",
-                        "message": "Invalid Content-Length header",
-                        "request_id": request_id
-                    },
-                    headers={"X-Request-ID": request_id}
+                await self._reject(
+                    scope,
+                    send,
+                    400,
+                    _INVALID_CONTENT_LENGTH_BODY,
+                    "Invalid Content-Length header received"
                 )
+                return
             
             # Determine limit based on endpoint
-            path = request.url.path
-            if "/batch" in path:
-                max_size = MAX_CONTENT_LENGTH_BATCH
-                endpoint_type = "batch"
-            elif path == "/" or "/ingest" in path:
-                max_size = MAX_CONTENT_LENGTH_INGEST
-                endpoint_type = "ingest"
-            else:
-                max_size = MAX_CONTENT_LENGTH_DEFAULT
-                endpoint_type = "default"
+            max_size, endpoint_type = PAYLOAD_LIMITS_BY_PATH.get(scope["path"], DEFAULT_PAYLOAD_LIMIT)
             
             if content_length > max_size:
-                log_with_context(
-                    "warning",
+                await self._reject(
+                    scope,
+                    send,
+                    HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    _PAYLOAD_TOO_LARGE_BODY,
                     "Payload size limit exceeded",
-                    request,
                     content_length=content_length,
                     max_size=max_size,
                     endpoint_type=endpoint_type
                 )
-                return JSONResponse(
-                    status_code=HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-                    content={
-                        "error": "Payload Too Large",
-                        "message": "Request body exceeds maximum allowed size",
-                        "request_id": request_id
-                    },
-                    headers={"X-Request-ID": request_id}
-                )
+                return
         
-        return await call_next(request)
+        await self.app(scope, receive, send)
+    
+    @staticmethod
+    async def _reject(
+        scope: Scope,
+        send: Send,
+        status_code: int,
+        template: bytes,
+        message: str,
+        **log_fields
+    ) -> None:
+        """Log and answer a rejected request."""
+        # This middleware runs before RequestIDMiddleware, so rejected
+        # requests get their ID here
+        request_id = new_request_id()
+        _current_request_id.set(request_id)
+        log_with_context("warning", message, Request(scope), **log_fields)
+        await send_json_error(send, status_code, template, request_id)
 
 
-# Register middleware (order matters - request ID should be outermost)
+# =============================================================================
+# API Key Authentication Middleware
+# =============================================================================
+# Paths served without an API key. Everything else requires one, including
+# unknown paths, so a new endpoint is protected unless it is listed here.
+PUBLIC_PATHS = frozenset({
+    "/health/live",
+    "/health/ready",
+    "/docs",
+    "/docs/oauth2-redirect",
+    "/redoc",
+    "/openapi.json",
+})
+
+
+class ApiKeyMiddleware:
+    """
+    Middleware to require a valid API key on all non-public endpoints.
+    
+    Returns 401 Unauthorized for missing or invalid API keys.
+    Logs authentication failures with request context.
+    
+    The X-API-Key header is read from the raw ASGI headers, so rejected and
+    accepted requests alike skip FastAPI's dependency resolution.
+    """
+    
+    def __init__(self, app: ASGIApp):
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"] in PUBLIC_PATHS:
+            await self.app(scope, receive, send)
+            return
+        
+        api_key = None
+        for name, value in scope["headers"]:
+            if name == _HDR_API_KEY:
+                api_key = value
+                break
+        
+        if not api_key:
+            log_with_context(
+                "warning",
+                "API request rejected: Missing API key",
+                Request(scope)
+            )
+            await send_json_error(send, HTTP_401_UNAUTHORIZED, _AUTHENTICATION_REQUIRED_BODY, get_request_id())
+            return
+        
+        if not secrets.compare_digest(hashlib.sha256(api_key).digest(), _API_KEY_DIGEST):
+            log_with_context(
+                "warning",
+                "API request rejected: Invalid API key",
+                Request(scope)
+            )
+            await send_json_error(send, HTTP_401_UNAUTHORIZED, _INVALID_CREDENTIALS_BODY, get_request_id())
+            return
+        
+        await self.app(scope, receive, send)
+
+
+def _openapi_with_api_key() -> Dict[str, Any]:
+    """
+    Build the OpenAPI schema with the API key requirement documented.
+    
+    Authentication is enforced by ApiKeyMiddleware rather than a route
+    dependency, so the security scheme is added to the generated schema.
+    """
+    if app.openapi_schema is None:
+        schema = _build_openapi()
+        schema.setdefault("components", {})["securitySchemes"] = {
+            "APIKeyHeader": {"type": "apiKey", "in": "header", "name": API_KEY_NAME}
+        }
+        for path, operations in schema.get("paths", {}).items():
+            if path not in PUBLIC_PATHS:
+                for operation in operations.values():
+                    operation["security"] = [{"APIKeyHeader": []}]
+    return app.openapi_schema
+
+
+_build_openapi = app.openapi
+app.openapi = _openapi_with_api_key
+
+
+# Register middleware (order matters - payload size check should be outermost)
 # Middleware is executed in reverse order of registration:
-# 1. RequestIDMiddleware (registered last, executed first - outermost)
-# 2. RequestTimeoutMiddleware (executed second)
-# 3. SlowAPIMiddleware (executed third)
-# 4. PayloadSizeLimitMiddleware (registered first, executed last - innermost)
-app.add_middleware(PayloadSizeLimitMiddleware)
-app.add_middleware(SlowAPIMiddleware)
+# 1. PayloadSizeLimitMiddleware (registered last, executed first - outermost)
+#    rejects oversized requests before any other middleware does work
+# 2. RequestIDMiddleware (executed second)
+# 3. ApiKeyMiddleware (executed third) - unauthenticated requests stop here
+# 4. RequestTimeoutMiddleware (registered first, executed last - innermost)
 app.add_middleware(RequestTimeoutMiddleware)
+app.add_middleware(ApiKeyMiddleware)
 app.add_middleware(RequestIDMiddleware)
+app.add_middleware(PayloadSizeLimitMiddleware)
 
 logger.info(
     "Secure middleware stack initialized",
@@ -758,35 +1079,44 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
     - Logs full details server-side
     - Returns sanitized response to client (no internal paths)
     """
-    request_id = get_request_id(request)
+    request_id = get_request_id()
+    
+    errors = exc.errors()
+    
+    # The full error list is only built if the log record will be emitted
+    log_details = logger.isEnabledFor(logging.WARNING)
     
     # Sanitize errors for client response (remove internal details)
     client_errors = []
     server_errors = []
     
-    for error in exc.errors():
-        # Full error for server logs
-        server_errors.append({
-            "field": ".".join(str(loc) for loc in error["loc"]),
-            "message": error["msg"],
-            "type": error["type"]
-        })
+    for error in errors:
+        loc = error["loc"]
+        msg = error["msg"]
         
         # Sanitized error for client (remove potential path info)
-        field_path = ".".join(str(loc) for loc in error["loc"] if loc != "body")
         client_errors.append({
-            "field": field_path,
-            "message": _sanitize_error_message(error["msg"])
+            "field": _join_loc(loc),
+            "message": _sanitize_error_message(msg)
         })
+        
+        # Full error for server logs
+        if log_details:
+            server_errors.append({
+                "field": ".".join(map(str, loc)),
+                "message": msg,
+                "type": error["type"]
+            })
     
     # Log full details server-side
-    log_with_context(
-        "warning",
-        "Request validation failed",
-        request,
-        error_count=len(server_errors),
-        errors=server_errors
-    )
+    if log_details:
+        log_with_context(
+            "warning",
+            "Request validation failed",
+            request,
+            error_count=len(errors),
+            errors=server_errors
+        )
     
     return JSONResponse(
         status_code=400,
@@ -807,7 +1137,7 @@ async def http_exception_handler(request: Request, exc: HTTPException):
     
     Ensures consistent error format and includes request ID.
     """
-    request_id = get_request_id(request)
+    request_id = get_request_id()
     
     # Log the exception server-side
     log_with_context(
@@ -831,7 +1161,7 @@ async def http_exception_handler(request: Request, exc: HTTPException):
             "message": _sanitize_error_message(message),
             "request_id": request_id
         },
-        headers={"X-Request-ID": request_id}
+        headers={**(exc.headers or {}), "X-Request-ID": request_id}
     )
 
 
@@ -843,7 +1173,7 @@ async def general_exception_handler(request: Request, exc: Exception):
     - Logs full exception details server-side (including traceback)
     - Returns generic error to client (no internal details exposed)
     """
-    request_id = get_request_id(request)
+    request_id = get_request_id()
     
     # Log full exception details server-side
     logger.error(
@@ -860,17 +1190,33 @@ async def general_exception_handler(request: Request, exc: Exception):
     )
     
     # Return generic error to client (no internal details)
-    return JSONResponse(
+    return Response(
+        content=render_error_body(_INTERNAL_ERROR_BODY, request_id),
         status_code=500,
-        content={
-            "error": "Internal Server Error",
-            "message": "An unexpected error occurred. Please try again later.",
-            "request_id": request_id
-        },
+        media_type="application/json",
         headers={"X-Request-ID": request_id}
     )
 
 
+# Sanitization rules, applied in order by _sanitize_error_message
+_SANITIZE_PATTERNS = [
+    # File paths (Unix and Windows)
+    (re.compile(r'(/[\w\-./]+\.py)'), '[file]'),
+    (re.compile(r'([A-Za-z]:\\[\w\-\\]+\.py)'), '[file]'),
+    # Line numbers
+    (re.compile(r'line \d+', re.IGNORECASE), 'line [N]'),
+    # Module references
+    (re.compile(r'in module [\w.]+'), 'in module [M]'),
+    # Memory addresses
+    (re.compile(r'0x[0-9a-fA-F]+'), '[addr]'),
+]
+
+
+def _join_loc(loc: Tuple[Union[str, int], ...]) -> str:
+    """Format a validation error location for clients, e.g. "events.1.timestamp"."""
+    return ".".join([str(part) for part in loc if part != "body"])
+
+
 def _sanitize_error_message(message: str) -> str:
     """
     Sanitize error messages to remove sensitive information.
@@ -884,151 +1230,526 @@ def _sanitize_error_message(message: str) -> str:
     if not message:
         return "An error occurred"
     
-    # Remove file paths (Unix and Windows)
-    message = re.sub(r'(/[\w\-./]+\.py)', '[file]', message)
-    message = re.sub(r'([A-Za-z]:\\[\w\-\\]+\.py)', '[file]', message)
-    
-    # Remove line numbers
-    message = re.sub(r'line \d+', 'line [N]', message, flags=re.IGNORECASE)
-    
-    # Remove module references
-    message = re.sub(r'in module [\w.]+', 'in module [M]', message)
-    
-    # Remove memory addresses
-    message = re.sub(r'0x[0-9a-fA-F]+', '[addr]', message)
+    for pattern, replacement in _SANITIZE_PATTERNS:
+        message = pattern.sub(replacement, message)
     
     return message
 
 
+_ERROR_NAMES = {
+    400: "Bad Request",
+    401: "Unauthorized",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    408: "Request Timeout",
+    413: "Payload Too Large",
+    422: "Unprocessable Entity",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+    504: "Gateway Timeout"
+}
+
+# Error name by status code (100-599) for a plain index lookup on error paths
+_ERROR_NAME_TABLE = tuple(_ERROR_NAMES.get(code, "Error") for code in range(600))
+
+
 def _get_error_name(status_code: int) -> str:
     """Get human-readable error name for HTTP status code."""
-    error_names = {
-        400: "Bad Request",
-        401: "Unauthorized",
-        403: "Forbidden",
-        404: "Not Found",
-        405: "Method Not Allowed",
-        408: "Request Timeout",
-        413: "Payload Too Large",
-        422: "Unprocessable Entity",
-        429: "Too Many Requests",
-        500: "Internal Server Error",
-        502: "Bad Gateway",
-        503: "Service Unavailable",
-        504: "Gateway Timeout"
-    }
-    return error_names.get(status_code, "Error")
+    if 0 <= status_code < 600:
+        return _ERROR_NAME_TABLE[status_code]
+    return "Error"
+
+
+def rate_limit(limiter: TokenBucketLimiter):
+    """
+    Build a dependency enforcing limiter per client IP.
+    
+    Returns 429 Too Many Requests with a Retry-After header when the
+    client has no tokens left.
+    """
+    async def check_rate_limit(request: Request):
+        client_ip = request.client.host if request.client else "unknown"
+        retry_after = limiter.check(client_ip)
+        if retry_after:
+            log_with_context(
+                "warning",
+                "API request rejected: Rate limit exceeded",
+                request
+            )
+            raise HTTPException(
+                status_code=HTTP_429_TOO_MANY_REQUESTS,
+                detail={"error": "Rate limit exceeded"},
+                headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+    
+    return check_rate_limit
 
+# =============================================================================
+# Wazuh Queue Socket
+# =============================================================================
+WAZUH_SOCKET_PATH = "/var/ossec/queue/sockets/queue"
+
+# Default to Wazuh-AWS if not specified, or use environment override.
+# Read once at import; call reload_decoder_header() after changing the
+# environment at runtime (e.g. in tests).
+DEFAULT_DECODER_HEADER = os.getenv("WAZUH_DECODER_HEADER", "1:Wazuh-AWS:")
+DEFAULT_DECODER_HEADER_BYTES = DEFAULT_DECODER_HEADER.encode()
+
+
+def reload_decoder_header() -> str:
+    """Re-read WAZUH_DECODER_HEADER and return the new default header."""
+    global DEFAULT_DECODER_HEADER, DEFAULT_DECODER_HEADER_BYTES
+    DEFAULT_DECODER_HEADER = os.getenv("WAZUH_DECODER_HEADER", "1:Wazuh-AWS:")
+    DEFAULT_DECODER_HEADER_BYTES = DEFAULT_DECODER_HEADER.encode()
+    return DEFAULT_DECODER_HEADER
+
+
+# Encoded "1:<decoder>:" headers by decoder name, so only the first event for
+# a decoder pays for formatting it. Decoder names come from clients, hence
+# the bound on the number of cached entries.
+DECODER_HEADER_CACHE_SIZE = 1024
+_decoder_headers: Dict[str, bytes] = {}
+
+# The queue is a datagram socket, so connect() only records the default peer
+# and a single socket can be reused for every event. It is created lazily on
+# first use and dropped on socket errors so that the next send reconnects.
+_wazuh_sock: Optional[socket.socket] = None
+_wazuh_sock_lock = threading.Lock()
+
+# Errors from a send on a socket whose peer went away, e.g. after an agent
+# restart re-created the queue socket. The daemon may well be up again, so
+# such a send is retried once on a freshly connected socket.
+STALE_SOCKET_ERRNOS = (errno.ECONNREFUSED, errno.ENOTCONN, errno.ENOENT)
+
+# SO_SNDBUF of the shared socket, read once when it is connected. A datagram
+# larger than the send buffer can never be sent on an AF_UNIX socket, so such
+# events are rejected up front instead of costing a failing send() call.
+_wazuh_sock_sndbuf = 0
+
+
+def _get_wazuh_socket() -> socket.socket:
+    """Return the shared Wazuh queue socket, connecting it on first use."""
+    global _wazuh_sock, _wazuh_sock_sndbuf
+    sock = _wazuh_sock
+    if sock is None:
+        with _wazuh_sock_lock:
+            if _wazuh_sock is None:
+                s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                try:
+                    s.connect(WAZUH_SOCKET_PATH)
+                    _wazuh_sock_sndbuf = s.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+                except OSError:
+                    s.close()
+                    raise
+                _wazuh_sock = s
+            sock = _wazuh_sock
+    return sock
+
+
+def _reset_wazuh_socket(sock: socket.socket) -> None:
+    """
+    Drop the shared socket after an error so the next send reconnects.
 
-api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
+    The socket is not closed explicitly since another thread may still be
+    sending on it; it is closed once the last reference goes away.
+    """
+    global _wazuh_sock
+    with _wazuh_sock_lock:
+        if _wazuh_sock is sock:
+            _wazuh_sock = None
 
 
-async def get_api_key(request: Request, api_key_header: str = Security(api_key_header)):
+def _send_datagram(datagram: bytes, flags: int = 0) -> None:
     """
-    Validate API key from request header.
+    Send one datagram on the shared Wazuh queue socket.
     
-    Returns 401 Unauthorized for missing or invalid API keys.
-    Logs authentication failures with request context.
+    A send failing with one of STALE_SOCKET_ERRNOS is retried once on a
+    reconnected socket. After any other socket error the socket is dropped
+    too, except for EMSGSIZE and a full queue, which leave it usable.
+    
+    Raises:
+        OSError: If the datagram could not be sent
     """
-    if not api_key_header:
-        log_with_context(
-            "warning",
-            "API request rejected: Missing API key",
-            request
-        )
-        raise HTTPException(
-            status_code=HTTP_401_UNAUTHORIZED,
-            detail={"error": "Authentication required"}
-        )
+    for attempt in range(2):
+        sock = _get_wazuh_socket()
+        try:
+            sock.send(datagram, flags)
+            return
+        except BlockingIOError:
+            raise
+        except OSError as e:
+            if e.errno == errno.EMSGSIZE:
+                raise
+            _reset_wazuh_socket(sock)
+            if attempt or e.errno not in STALE_SOCKET_ERRNOS:
+                raise
+
+
+# sendmmsg(2) hands a whole batch of datagrams to the kernel in one call.
+# Python does not wrap it, so it is called through ctypes where available
+# and send_msgs_bulk falls back to one send() per datagram otherwise.
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_char_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.c_void_p),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    """Return libc's sendmmsg, or None if the platform does not provide it."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        func = ctypes.CDLL(None, use_errno=True).sendmmsg
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    func.restype = ctypes.c_int
+    return func
+
+
+_sendmmsg = _load_sendmmsg()
+
+
+def _send_datagrams(sock: socket.socket, datagrams: List[bytes]) -> int:
+    """
+    Send datagrams in order, returning how many were sent.
     
-    if not secrets.compare_digest(api_key_header, API_KEY):
-        log_with_context(
-            "warning",
-            "API request rejected: Invalid API key",
-            request
-        )
-        raise HTTPException(
-            status_code=HTTP_401_UNAUTHORIZED,
-            detail={"error": "Invalid credentials"}
-        )
+    Like sendmmsg(2), OSError is only raised when the first datagram fails;
+    callers resume from the returned count otherwise.
+    """
+    count = len(datagrams)
+    
+    if _sendmmsg is None:
+        for i, datagram in enumerate(datagrams):
+            try:
+                sock.send(datagram)
+            except OSError:
+                if i == 0:
+                    raise
+                return i
+        return count
+    
+    iovecs = (_IOVec * count)()
+    headers = (_MMsgHdr * count)()
+    iovec_addr = ctypes.addressof(iovecs)
+    iovec_size = ctypes.sizeof(_IOVec)
+    for i, datagram in enumerate(datagrams):
+        iovec = iovecs[i]
+        iovec.iov_base = datagram
+        iovec.iov_len = len(datagram)
+        header = headers[i].msg_hdr
+        header.msg_iov = iovec_addr + i * iovec_size
+        header.msg_iovlen = 1
+    
+    while True:
+        sent = _sendmmsg(sock.fileno(), headers, count, 0)
+        if sent >= 0:
+            return sent
+        err = ctypes.get_errno()
+        if err != errno.EINTR:
+            raise OSError(err, os.strerror(err))
+
+
+def _decoder_header(decoder: Optional[str]) -> bytes:
+    """Return the encoded queue header for a decoder (default if None)."""
+    if decoder is None:
+        return DEFAULT_DECODER_HEADER_BYTES
+    
+    header = _decoder_headers.get(decoder)
+    if header is None:
+        header = b"1:" + decoder.encode() + b":"
+        if len(_decoder_headers) < DECODER_HEADER_CACHE_SIZE:
+            _decoder_headers[decoder] = header
+    return header
+
+
+def _dump_json(msg: dict) -> bytes:
+    """Serialize an event body with orjson, falling back to the json module."""
+    try:
+        return orjson.dumps(msg)
+    except orjson.JSONEncodeError:
+        # e.g. integers beyond 64 bits, which orjson refuses
+        return json.dumps(msg).encode()
+
+
+def encode_event(event: IngestEvent) -> bytes:
+    """
+    Encode a validated event as the JSON body sent to the Wazuh queue.
+    
+    The model's field values are serialized directly; model_dump() would
+    only build a copy of them that is thrown away after serialization, and
+    model_dump_json() measured slower than orjson on this dict once the
+    "ingest" marker has to be added to its output.
+    """
+    data = {key: value for key, value in event.__dict__.items() if value is not None}
+    data['ingest'] = "api"
+    return _dump_json(data)
+
+
+def _socket_error_result(e: OSError, request_id: Optional[str]) -> dict:
+    """Log a socket error and map it to a sanitized result for the client."""
+    # Log full error server-side, return sanitized message to client
+    logger.error(
+        "Socket communication error",
+        extra={
+            "request_id": request_id,
+            "error_code": e.errno,
+            "error_type": "socket_error"
+        }
+    )
     
-    return api_key_header
+    if e.errno == errno.EMSGSIZE:
+        return {"status": "error", "message": "Message exceeds size limit"}
+
+    if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+        return {"status": "error", "message": "Backend service unavailable"}
+    else:
+        return {"status": "error", "message": "Communication error"}
+
+
+def _oversized_result(size: int, request_id: Optional[str]) -> dict:
+    """Log an event too large for the queue socket and return its result."""
+    logger.error(
+        "Message exceeds socket send buffer",
+        extra={
+            "request_id": request_id,
+            "message_size": size,
+            "max_size": _wazuh_sock_sndbuf,
+            "error_type": "socket_error"
+        }
+    )
+    return {"status": "error", "message": "Message exceeds size limit"}
+
+
+def _unexpected_error_result(e: Exception, request_id: Optional[str]) -> dict:
+    """Log an unexpected delivery error and return a generic result."""
+    # Log full exception server-side
+    logger.error(
+        "Unexpected error in message delivery",
+        extra={
+            "request_id": request_id,
+            "exception_type": type(e).__name__
+        },
+        exc_info=True
+    )
+    return {"status": "error", "message": "An unexpected error occurred"}
+
 
-def send_msg(msg: dict, request_id: Optional[str] = None):
+def _send_event(msg_json: bytes, decoder: Optional[str], request_id: Optional[str], flags: int = 0) -> dict:
     """
-    Sends an event to the Wazuh Queue.
+    Send one encoded event and map the outcome to a result dict.
     
     Args:
-        msg: Event data to send
+        msg_json: Encoded JSON event (see encode_event)
+        decoder: Optional decoder name; the default header is used if None
         request_id: Optional request ID for log correlation
+        flags: Flags for send(), e.g. socket.MSG_DONTWAIT
     
     Returns:
         Dict with status and message
+    
+    Raises:
+        BlockingIOError: If flags include MSG_DONTWAIT and the queue is full
     """
+    try:
+        _get_wazuh_socket()
+        datagram = _decoder_header(decoder) + msg_json
+        if len(datagram) > _wazuh_sock_sndbuf:
+            return _oversized_result(len(datagram), request_id)
+        _send_datagram(datagram, flags)
+        return {"status": "success", "message": "Event sent to Wazuh"}
     
-    # Determine decoder header
-    # Default to Wazuh-AWS if not specified, or use environment override
-    default_header = os.getenv("WAZUH_DECODER_HEADER", "1:Wazuh-AWS:")
+    except BlockingIOError:
+        raise
+        
+    except socket.error as e:
+        return _socket_error_result(e, request_id)
+            
+    except Exception as e:
+        return _unexpected_error_result(e, request_id)
+
+
+def send_msg_json(msg_json: bytes, decoder: Optional[str] = None, request_id: Optional[str] = None):
+    """
+    Sends an event that is already serialized to JSON to the Wazuh Queue.
     
-    if 'decoder' in msg:
-        message_header = "1:{0}:".format(msg['decoder'])
-    else:
-        message_header = default_header
+    Args:
+        msg_json: Encoded JSON event (see encode_event)
+        decoder: Optional decoder name; the default header is used if None
+        request_id: Optional request ID for log correlation
+    
+    Returns:
+        Dict with status and message
+    """
+    return _send_event(msg_json, decoder, request_id)
+
 
-    msg['ingest'] = "api"
+async def _run_in_thread_bounded(semaphore: asyncio.Semaphore, func, *args):
+    """
+    Run func(*args) in a worker thread while holding a semaphore slot.
     
+    Unlike "async with semaphore: await asyncio.to_thread(...)", the slot is
+    only released once the thread has returned. A cancelled caller (e.g. a
+    request timed out by RequestTimeoutMiddleware) cannot stop a thread
+    blocked in send(), so releasing the slot on cancellation would let
+    blocked threads pile up past the bound.
+    """
+    await semaphore.acquire()
     try:
-        s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-        # Verify socket path exists
-        socket_path = "/var/ossec/queue/sockets/queue"
-        if not os.path.exists(socket_path):
-            logger.error(
-                "Wazuh socket not available",
-                extra={"request_id": request_id, "socket_path": "[internal]"}
-            )
-            return {"status": "error", "message": "Backend service unavailable"}
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(None, functools.partial(copy_context().run, func, *args))
+    except BaseException:
+        semaphore.release()
+        raise
+    future.add_done_callback(lambda _: semaphore.release())
+    # Shielded so that cancelling the caller does not cancel the future,
+    # which would run the release callback while the thread is still busy
+    return await asyncio.shield(future)
 
-        s.connect(socket_path)
-        
-        # Format message
-        json_msg = json.dumps(msg)
-        full_message = "{header}{msg}".format(header=message_header, msg=json_msg)
-        
-        encoded_msg = full_message.encode()
 
-        s.send(encoded_msg)
-        s.close()
-        return {"status": "success", "message": "Event sent to Wazuh"}
-        
-    except socket.error as e:
-        # Log full error server-side, return sanitized message to client
-        logger.error(
-            "Socket communication error",
-            extra={
-                "request_id": request_id,
-                "error_code": e.errno,
-                "error_type": "socket_error"
-            }
+_ingest_send_semaphore = asyncio.Semaphore(INGEST_SEND_CONCURRENCY)
+
+
+async def send_msg_json_async(msg_json: bytes, decoder: Optional[str] = None, request_id: Optional[str] = None):
+    """
+    Sends a JSON-serialized event to the Wazuh Queue without blocking the event loop.
+    
+    The datagram is first sent with MSG_DONTWAIT, which succeeds immediately
+    unless the queue is full. Only then is the blocking send_msg_json
+    moved to a worker thread to wait for room in the queue, at most
+    INGEST_SEND_CONCURRENCY at a time so that waiting events cannot take
+    every thread of the default executor. A slot is held until the thread
+    returns, also when the request is cancelled first.
+    
+    Args:
+        msg_json: Encoded JSON event (see encode_event)
+        decoder: Optional decoder name; the default header is used if None
+        request_id: Optional request ID for log correlation
+    
+    Returns:
+        Dict with status and message
+    """
+    try:
+        return _send_event(msg_json, decoder, request_id, socket.MSG_DONTWAIT)
+    except BlockingIOError:
+        return await _run_in_thread_bounded(
+            _ingest_send_semaphore, send_msg_json, msg_json, decoder, request_id
         )
+
+
+# Shared by every delivered event in a bulk send; callers must not modify it
+BULK_SUCCESS_RESULT = {"status": "success", "message": "Event sent to Wazuh"}
+
+
+_batch_send_semaphore = asyncio.Semaphore(BATCH_SEND_CONCURRENCY)
+
+
+async def send_msgs_bulk_async(msgs: List[Tuple[bytes, Optional[str]]], request_id: Optional[str] = None) -> List[dict]:
+    """
+    Run send_msgs_bulk in a worker thread, at most BATCH_SEND_CONCURRENCY at a time.
+    
+    The bulk send blocks while the Wazuh queue is full, so it must not run
+    on the event loop; the semaphore stops a burst of batches from taking
+    every thread of the default executor. A slot is held until the thread
+    returns, also when the request is cancelled first.
+    """
+    return await _run_in_thread_bounded(_batch_send_semaphore, send_msgs_bulk, msgs, request_id)
+
+
+def send_msgs_bulk(msgs: List[Tuple[bytes, Optional[str]]], request_id: Optional[str] = None) -> List[dict]:
+    """
+    Sends a batch of already encoded events to the Wazuh Queue.
+    
+    The datagrams are handed to the kernel together (a single sendmmsg
+    call where available) rather than one send per event.
+    
+    Args:
+        msgs: (JSON body, decoder) pairs, the body as produced by encode_event
+        request_id: Optional request ID for log correlation
+    
+    Returns:
+        List of dicts with status and message, one per event in input order.
+        Events that failed the same way share one result dict.
+    """
+    datagrams = [_decoder_header(decoder) + msg_json for msg_json, decoder in msgs]
+    count = len(datagrams)
+    
+    # Only failed events get their own result, keyed by position; every
+    # delivered event shares the same success result.
+    errors: Dict[int, dict] = {}
+    
+    sock = None
+    indexes = range(count)
+    done = 0
+    try:
+        sock = _get_wazuh_socket()
         
-        if e.errno == 111:
-            return {"status": "error", "message": "Backend service unavailable"}
-        elif e.errno == 90:
-            return {"status": "error", "message": "Message exceeds size limit"}
-        else:
-            return {"status": "error", "message": "Communication error"}
-            
+        # Events that cannot fit the send buffer fail on their own; only the
+        # rest are handed to the kernel
+        max_size = _wazuh_sock_sndbuf
+        pending = datagrams
+        if any(len(datagram) > max_size for datagram in datagrams):
+            indexes = []
+            for i, datagram in enumerate(datagrams):
+                if len(datagram) > max_size:
+                    errors[i] = _oversized_result(len(datagram), request_id)
+                else:
+                    indexes.append(i)
+            pending = [datagrams[i] for i in indexes]
+        
+        reconnected = False
+        while done < len(pending):
+            try:
+                done += _send_datagrams(sock, pending[done:])
+            except socket.error as e:
+                if e.errno in STALE_SOCKET_ERRNOS and not reconnected:
+                    # The queue socket was re-created (agent restart); send the
+                    # rest of the batch once more on a reconnected socket
+                    _reset_wazuh_socket(sock)
+                    sock = None
+                    sock = _get_wazuh_socket()
+                    reconnected = True
+                    continue
+                # An oversized event only fails itself; carry on with the rest
+                if e.errno != errno.EMSGSIZE:
+                    raise
+                errors[indexes[done]] = _socket_error_result(e, request_id)
+                done += 1
+    
+    except socket.error as e:
+        # The socket is unusable, so every event not yet sent fails the same way
+        # (reconnect on the next send: socket missing, daemon restarted, ...)
+        if sock is not None:
+            _reset_wazuh_socket(sock)
+        error = _socket_error_result(e, request_id)
+        for i in indexes[done:]:
+            errors[i] = error
+    
     except Exception as e:
-        # Log full exception server-side
-        logger.error(
-            "Unexpected error in message delivery",
-            extra={
-                "request_id": request_id,
-                "exception_type": type(e).__name__
-            },
-            exc_info=True
-        )
-        return {"status": "error", "message": "An unexpected error occurred"}
+        error = _unexpected_error_result(e, request_id)
+        for i in indexes[done:]:
+            errors[i] = error
+    
+    if not errors:
+        return [BULK_SUCCESS_RESULT] * count
+    return [errors.get(i, BULK_SUCCESS_RESULT) for i in range(count)]
 
 
 # =============================================================================
@@ -1045,30 +1766,58 @@ def get_uptime() -> float:
     return time.time() - SERVICE_START_TIME
 
 
-def check_wazuh_socket() -> bool:
+# Health endpoints are polled by orchestrators and load balancers; the socket
+# probe result is reused for this many seconds instead of probing every hit.
+HEALTH_CHECK_CACHE_TTL = 1.0
+_socket_check_cache: Tuple[float, bool] = (float("-inf"), False)
+_socket_check_lock = asyncio.Lock()
+
+
+def _probe_wazuh_socket() -> bool:
     """
-    Check if the Wazuh socket is available and connectable.
+    Try to connect to the Wazuh socket.
     
-    Returns:
-        True if the socket exists and can be connected to, False otherwise.
+    connect() fails with ENOENT when the socket file is missing and with
+    ECONNREFUSED when nothing is bound to it, so no separate stat is needed.
     """
-    socket_path = "/var/ossec/queue/sockets/queue"
-    
-    # First check if the socket file exists
-    if not os.path.exists(socket_path):
-        return False
-    
-    # Try to connect to verify it's actually working
     try:
         s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-        s.settimeout(2.0)  # 2 second timeout for connection test
-        s.connect(socket_path)
-        s.close()
+        try:
+            s.settimeout(2.0)  # 2 second timeout for connection test
+            s.connect(WAZUH_SOCKET_PATH)
+        finally:
+            s.close()
         return True
     except (socket.error, OSError):
         return False
 
 
+async def check_wazuh_socket() -> bool:
+    """
+    Check if the Wazuh socket is available and connectable.
+    
+    The result is cached for HEALTH_CHECK_CACHE_TTL seconds. When it has
+    expired, one caller probes the socket in a worker thread while
+    concurrent callers wait for that result instead of probing too.
+    
+    Returns:
+        True if the socket can be connected to, False otherwise.
+    """
+    global _socket_check_cache
+    checked_at, connected = _socket_check_cache
+    if time.monotonic() - checked_at < HEALTH_CHECK_CACHE_TTL:
+        return connected
+    
+    async with _socket_check_lock:
+        checked_at, connected = _socket_check_cache
+        if time.monotonic() - checked_at < HEALTH_CHECK_CACHE_TTL:
+            return connected
+        
+        connected = await asyncio.to_thread(_probe_wazuh_socket)
+        _socket_check_cache = (time.monotonic(), connected)
+        return connected
+
+
 # =============================================================================
 # Health Check Endpoints
 # =============================================================================
@@ -1104,7 +1853,7 @@ async def readiness_probe():
     - Kubernetes readinessProbe
     - Load balancer health checks before routing traffic
     """
-    if check_wazuh_socket():
+    if await check_wazuh_socket():
         return {"status": "ready", "wazuh_socket": "connected"}
     else:
         raise HTTPException(
@@ -1117,7 +1866,7 @@ async def readiness_probe():
         )
 
 
-@app.get("/health", dependencies=[Depends(get_api_key)])
+@app.get("/health")
 async def health_check(request: Request):
     """
     Comprehensive health check endpoint with detailed status information.
@@ -1132,8 +1881,8 @@ async def health_check(request: Request):
     - Current timestamp
     - Request ID for correlation
     """
-    request_id = get_request_id(request)
-    wazuh_connected = check_wazuh_socket()
+    request_id = get_request_id()
+    wazuh_connected = await check_wazuh_socket()
     uptime_seconds = get_uptime()
     
     # Determine overall health status
@@ -1156,8 +1905,94 @@ async def health_check(request: Request):
     }
 
 
-@app.post("/ingest", dependencies=[Depends(get_api_key)])
-async def ingest_event(request: Request, event: IngestEvent):
+# =============================================================================
+# Request Body Parsing
+# =============================================================================
+# The ingest endpoints read the raw body and validate it with
+# model_validate_json, so JSON parsing and validation happen in a single
+# pass instead of FastAPI decoding to a dict and Pydantic walking it again.
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+
+async def read_body(request: Request, max_size: int) -> bytes:
+    """
+    Read the request body, rejecting it as soon as it grows past max_size.
+    
+    The Content-Length check in PayloadSizeLimitMiddleware does not cover
+    chunked uploads or clients that under-declare the length, so the cap is
+    enforced again while streaming instead of buffering the whole payload.
+    
+    Args:
+        request: Incoming request
+        max_size: Maximum accepted body size in bytes
+    
+    Returns:
+        The complete request body
+    
+    Raises:
+        HTTPException: 413 if the body exceeds max_size
+    """
+    body = bytearray()
+    async for chunk in request.stream():
+        if len(body) + len(chunk) > max_size:
+            log_with_context(
+                "warning",
+                "Payload size limit exceeded while reading body",
+                request,
+                max_size=max_size
+            )
+            raise HTTPException(
+                status_code=HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail={
+                    "error": "Payload Too Large",
+                    "message": "Request body exceeds maximum allowed size"
+                }
+            )
+        body += chunk
+    return bytes(body)
+
+
+def parse_body(model: Type[ModelT], body: bytes) -> ModelT:
+    """
+    Parse and validate a JSON request body against a Pydantic model.
+    
+    Raises RequestValidationError on invalid JSON or schema violations so
+    the error is reported by validation_exception_handler like any other
+    request validation failure.
+    """
+    try:
+        return model.model_validate_json(body)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors(include_url=False), body=body)
+
+
+def _inline_schema_refs(node: Any, defs: Dict[str, Any]) -> Any:
+    """Replace local "#/$defs/..." references with the referenced schema."""
+    if isinstance(node, dict):
+        ref = node.get("$ref")
+        if isinstance(ref, str) and ref.startswith("#/$defs/"):
+            return _inline_schema_refs(defs[ref[len("#/$defs/"):]], defs)
+        return {key: _inline_schema_refs(value, defs) for key, value in node.items()}
+    if isinstance(node, list):
+        return [_inline_schema_refs(item, defs) for item in node]
+    return node
+
+
+def json_body_openapi(model: Type[BaseModel]) -> Dict[str, Any]:
+    """OpenAPI requestBody for endpoints that parse the body via parse_body."""
+    schema = model.model_json_schema()
+    defs = schema.pop("$defs", {})
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": _inline_schema_refs(schema, defs)}}
+        }
+    }
+
+
+@app.post("/ingest", openapi_extra=json_body_openapi(IngestEvent))
+async def ingest_event(request: Request):
     """
     Ingest a single log event.
     
@@ -1165,11 +2000,10 @@ async def ingest_event(request: Request, event: IngestEvent):
     Required fields: timestamp, source, message
     Optional fields: level, tags, metadata, decoder
     """
-    request_id = get_request_id(request)
+    request_id = get_request_id()
+    event = parse_body(IngestEvent, await read_body(request, MAX_CONTENT_LENGTH_INGEST))
     
-    # Convert Pydantic model to dict for send_msg
-    event_data = event.dict(exclude_none=True)
-    result = send_msg(event_data, request_id)
+    result = await send_msg_json_async(encode_event(event), event.decoder, request_id)
     
     # Add request ID to response
     result["request_id"] = request_id
@@ -1186,26 +2020,26 @@ async def ingest_event(request: Request, event: IngestEvent):
     return result
 
 
-@app.post("/batch", dependencies=[Depends(get_api_key)])
-@limiter.limit("100/minute")
-async def ingest_batch(request: Request, batch: BatchIngestRequest):
+@app.post(
+    "/batch",
+    dependencies=[Depends(rate_limit(batch_limiter))],
+    openapi_extra=json_body_openapi(BatchIngestRequest)
+)
+async def ingest_batch(request: Request):
     """
     Ingest multiple log events in a batch.
     
     Each event in the batch is validated against the IngestEvent schema.
     Maximum 1000 events per batch.
     """
-    request_id = get_request_id(request)
-    results = []
-    error_count = 0
-    
-    for event in batch.events:
-        # Convert Pydantic model to dict for send_msg
-        event_data = event.dict(exclude_none=True)
-        res = send_msg(event_data, request_id)
-        if res.get("status") == "error":
-            error_count += 1
-        results.append(res)
+    request_id = get_request_id()
+    batch = parse_body(BatchIngestRequest, await read_body(request, MAX_CONTENT_LENGTH_BATCH))
+    
+    # Encode every event up front and hand the whole batch to the queue
+    # in one call, off the event loop
+    encoded_events = [(encode_event(event), event.decoder) for event in batch.events]
+    results = await send_msgs_bulk_async(encoded_events, request_id)
+    error_count = sum(1 for res in results if res.get("status") == "error")
     
     # Log batch processing summary
     log_with_context(
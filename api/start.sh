@@ -10,6 +10,8 @@ PORT="${API_PORT:-9000}"
 # --timeout-keep-alive: Close idle connections after 5 seconds (prevents slow client attacks)
 # --limit-concurrency: Maximum concurrent connections (prevents resource exhaustion)
 # --limit-max-requests: Restart worker after N requests (memory leak protection)
+# --loop uvloop / --http httptools: libuv event loop and C HTTP parser
+#   (both installed by uvicorn[standard]) instead of the pure-Python defaults
 TIMEOUT_KEEP_ALIVE="${UVICORN_TIMEOUT_KEEP_ALIVE:-5}"
 LIMIT_CONCURRENCY="${UVICORN_LIMIT_CONCURRENCY:-100}"
 LIMIT_MAX_REQUESTS="${UVICORN_LIMIT_MAX_REQUESTS:-10000}"
@@ -18,6 +20,7 @@ CMD="uvicorn api:app --host 0.0.0.0 --port $PORT --proxy-headers"
 CMD="$CMD --timeout-keep-alive $TIMEOUT_KEEP_ALIVE"
 CMD="$CMD --limit-concurrency $LIMIT_CONCURRENCY"
 CMD="$CMD --limit-max-requests $LIMIT_MAX_REQUESTS"
+CMD="$CMD --loop uvloop --http httptools"
 CMD="$CMD --access-log"
 CMD="$CMD --log-level info"
 
@@ -0,0 +1,398 @@
+"""
+Tests for the Wazuh Log Ingestion API (api/api.py).
+
+Run from the repository root:
+    python -m unittest discover -s api/tests
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+os.environ.setdefault("API_KEY", "test-api-key")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+
+# =============================================================================
+# SensitiveDataFilter
+# =============================================================================
+def redact_one_pattern_at_a_time(text: str) -> str:
+    """Reference redaction: the original loop over SENSITIVE_PATTERNS."""
+    for pattern, replacement in api.SensitiveDataFilter.SENSITIVE_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+class SensitiveDataFilterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.filter = api.SensitiveDataFilter()
+
+    def test_overlapping_patterns_redact_whole_value(self):
+        cases = {
+            "aws_secret=p@ssw0rd!": "aws_secret=[REDACTED]",
+            "aws_secret=abc.def": "aws_secret=[REDACTED]",
+            "token: api_key=xyz": "token=[REDACTED]=[REDACTED]",
+            "token: password=password=hunter2": "token=[REDACTED]=[REDACTED]",
+        }
+        for text, expected in cases.items():
+            with self.subTest(text=text):
+                self.assertEqual(self.filter._redact_sensitive(text), expected)
+
+    def test_keywords_match_like_ignorecase(self):
+        # re.IGNORECASE matches 'ſ' (U+017F) for 's' and 'K' (U+212A) for 'k'
+        cases = {
+            "paſſword=hunter2": "password=[REDACTED]",
+            "ſecret=abc": "secret=[REDACTED]",
+            "api_\u212aey=abc": "api_key=[REDACTED]",
+        }
+        for text, expected in cases.items():
+            with self.subTest(text=text):
+                self.assertEqual(self.filter._redact_sensitive(text), expected)
+
+    def test_filter_redacts_string_args_only(self):
+        class UnreprableArg:
+            def __repr__(self):
+                raise RuntimeError("no repr")
+
+            def __str__(self):
+                return "obj"
+
+        arg = UnreprableArg()
+        record = logging.LogRecord("test", logging.INFO, __file__, 1, "%s %s %s", ("password=hunter2", arg, 3), None)
+        self.assertTrue(self.filter.filter(record))
+        self.assertEqual(record.args[0], "password=[REDACTED]")
+        self.assertIs(record.args[1], arg)
+        self.assertEqual(record.getMessage(), "password=[REDACTED] obj 3")
+
+        record = logging.LogRecord("test", logging.INFO, __file__, 1, "value %s", (arg,), None)
+        self.assertTrue(self.filter.filter(record))
+        self.assertEqual(record.getMessage(), "value obj")
+
+    def test_text_without_keywords_is_unchanged(self):
+        text = "Event forwarded to Wazuh in 3ms from 10.0.0.1"
+        self.assertEqual(self.filter._redact_sensitive(text), text)
+
+    def test_matches_one_pattern_at_a_time_reference(self):
+        fragments = [
+            "api_key", "api-key", "X-API-Key", "authorization", "Bearer ", "password",
+            "passwd", "secret", "aws_secret", "aws_access_key", "token", "access_token",
+            "refresh_token", "=", ":", ": ", "'", '"', " ", ",", "}", "]", ".", "-", "/",
+            "+", "@", "!", "abc", "XYZ", "hunter2", "0x1f", "é", "ſ", "\u212a", "ſecret", "paſſwd", "\u212aey",
+        ]
+        rng = random.Random(1234)
+        for _ in range(20000):
+            text = "".join(rng.choice(fragments) for _ in range(rng.randint(1, 8)))
+            self.assertEqual(
+                self.filter._redact_sensitive(text),
+                redact_one_pattern_at_a_time(text),
+                msg=repr(text)
+            )
+
+
+# =============================================================================
+# Unexpected Delivery Errors
+# =============================================================================
+class UnexpectedErrorLoggingTests(unittest.TestCase):
+
+    def test_every_record_carries_the_exception(self):
+        with self.assertLogs(api.logger, "ERROR") as logs:
+            for request_id in ("rid-1", "rid-2"):
+                try:
+                    raise ValueError("boom")
+                except ValueError as e:
+                    result = api._unexpected_error_result(e, request_id)
+                self.assertEqual(result, {"status": "error", "message": "An unexpected error occurred"})
+
+        formatter = api.JSONFormatter()
+        for record, request_id in zip(logs.records, ("rid-1", "rid-2")):
+            entry = json.loads(formatter.format(record))
+            self.assertEqual(entry["request_id"], request_id)
+            self.assertEqual(entry["exception"], {"type": "ValueError", "message": "boom"})
+
+
+# =============================================================================
+# Error Message Sanitization
+# =============================================================================
+class SanitizeErrorMessageTests(unittest.TestCase):
+
+    def test_masks_internal_details(self):
+        cases = {
+            "in module C:\\-": "in module [M]:\\-",
+            "C:\\0xC:\\0x0x23": "C:\\[addr]:\\[addr]x23",
+            'File "/app/api.py", line 42, in module api.models': "File \"[file]\", line [N], in module [M]",
+            "object at 0x7f3a2b": "object at [addr]",
+        }
+        for message, expected in cases.items():
+            with self.subTest(message=message):
+                self.assertEqual(api._sanitize_error_message(message), expected)
+
+    def test_empty_message(self):
+        self.assertEqual(api._sanitize_error_message(""), "An error occurred")
+
+
+# =============================================================================
+# Rate Limiting
+# =============================================================================
+class TokenBucketLimiterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(api.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_retry_after(self):
+        limiter = api.TokenBucketLimiter(capacity=2, per_seconds=2)
+        self.assertEqual(limiter.check("a"), 0.0)
+        self.assertEqual(limiter.check("a"), 0.0)
+        self.assertAlmostEqual(limiter.check("a"), 1.0)
+        # Other clients have their own bucket
+        self.assertEqual(limiter.check("b"), 0.0)
+
+    def test_refills_over_time(self):
+        limiter = api.TokenBucketLimiter(capacity=2, per_seconds=2)
+        limiter.check("a")
+        limiter.check("a")
+        self.now += 0.5
+        self.assertAlmostEqual(limiter.check("a"), 0.5)
+        self.now += 0.5
+        self.assertEqual(limiter.check("a"), 0.0)
+        # Refill is capped at capacity however long the client was idle
+        self.now += 3600
+        self.assertEqual(limiter.check("a"), 0.0)
+        self.assertEqual(limiter.check("a"), 0.0)
+        self.assertGreater(limiter.check("a"), 0.0)
+
+    def test_evicts_least_recently_used_beyond_max_keys(self):
+        limiter = api.TokenBucketLimiter(capacity=1, per_seconds=60, max_keys=2)
+        limiter.check("a")
+        limiter.check("b")
+        limiter.check("a")  # "b" is now the least recently used
+        limiter.check("c")
+        self.assertEqual(list(limiter._buckets), ["a", "c"])
+        # An evicted client starts again with a full bucket
+        self.assertEqual(limiter.check("b"), 0.0)
+        self.assertEqual(list(limiter._buckets), ["c", "b"])
+
+
+class RateLimitDependencyTests(unittest.TestCase):
+
+    def test_batch_returns_429_with_retry_after(self):
+        client = TestClient(api.app, raise_server_exceptions=False)
+        # Drain the bucket of TestClient's client address
+        api.batch_limiter._buckets["testclient"] = (0.0, api.time.monotonic())
+        self.addCleanup(api.batch_limiter._buckets.pop, "testclient", None)
+
+        response = client.post("/batch", json={"events": []}, headers={api.API_KEY_NAME: api.API_KEY})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers["Retry-After"], "1")
+        self.assertEqual(response.json()["message"], "Rate limit exceeded")
+
+
+# =============================================================================
+# API Key Authentication
+# =============================================================================
+class ApiKeyMiddlewareTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.client = TestClient(api.app, raise_server_exceptions=False)
+        cls.headers = {api.API_KEY_NAME: api.API_KEY}
+
+    def assert_unauthorized(self, response, message):
+        self.assertEqual(response.status_code, 401)
+        body = response.json()
+        self.assertEqual(body["message"], message)
+        self.assertTrue(response.headers["X-Request-ID"])
+        self.assertEqual(body["request_id"], response.headers["X-Request-ID"])
+
+    def test_missing_key_is_rejected(self):
+        self.assert_unauthorized(self.client.post("/ingest", json={}), "Authentication required")
+
+    def test_wrong_key_is_rejected(self):
+        for key in ("wrong-key", api.API_KEY + "x", "\u00e9"):
+            with self.subTest(key=key):
+                response = self.client.post("/ingest", json={}, headers={api.API_KEY_NAME: key.encode()})
+                self.assert_unauthorized(response, "Invalid credentials")
+
+    def test_protected_paths_require_key(self):
+        for method, path in (("GET", "/health"), ("POST", "/ingest"), ("POST", "/batch"), ("GET", "/unknown")):
+            with self.subTest(path=path):
+                self.assert_unauthorized(self.client.request(method, path), "Authentication required")
+
+    def test_valid_key_is_accepted(self):
+        response = self.client.get("/health", headers=self.headers)
+        self.assertIn(response.status_code, (200, 503))
+        self.assertIn("status", response.json())
+
+    def test_public_paths_need_no_key(self):
+        for path in sorted(api.PUBLIC_PATHS):
+            with self.subTest(path=path):
+                response = self.client.get(path)
+                # /health/ready is 503 here since no Wazuh queue socket exists
+                self.assertIn(response.status_code, (200, 503) if path == "/health/ready" else (200,))
+
+
+# =============================================================================
+# Wazuh Queue Socket
+# =============================================================================
+class WazuhQueueSocketTests(unittest.TestCase):
+    """Sends against a stand-in queue socket bound in a temporary directory."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "queue")
+        self.receiver = self.bind_queue()
+        self.addCleanup(self.cleanup)
+
+        self.original_path = api.WAZUH_SOCKET_PATH
+        api.WAZUH_SOCKET_PATH = self.path
+        api._wazuh_sock = None
+
+    def cleanup(self):
+        api.WAZUH_SOCKET_PATH = self.original_path
+        if api._wazuh_sock is not None:
+            api._wazuh_sock.close()
+            api._wazuh_sock = None
+        self.receiver.close()
+        self.tmpdir.cleanup()
+
+    def bind_queue(self) -> socket.socket:
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.bind(self.path)
+        receiver.settimeout(1)
+        return receiver
+
+    def restart_queue(self):
+        """Re-create the queue socket the way an agent restart does."""
+        self.receiver.close()
+        os.unlink(self.path)
+        self.receiver = self.bind_queue()
+
+    def test_send_reconnects_after_queue_restart(self):
+        self.assertEqual(api.send_msg_json(b'{"n":1}')["status"], "success")
+        self.assertEqual(self.receiver.recv(4096), b"1:Wazuh-AWS:" + b'{"n":1}')
+
+        self.restart_queue()
+        self.assertEqual(api.send_msg_json(b'{"n":2}', "custom")["status"], "success")
+        self.assertEqual(self.receiver.recv(4096), b'1:custom:{"n":2}')
+
+    def test_async_send_reconnects_after_queue_restart(self):
+        api.send_msg_json(b'{"n":1}')
+        self.receiver.recv(4096)
+
+        self.restart_queue()
+        result = asyncio.run(api.send_msg_json_async(b'{"n":2}'))
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(self.receiver.recv(4096), b'1:Wazuh-AWS:{"n":2}')
+
+    def test_bulk_send_reconnects_after_queue_restart(self):
+        api.send_msg_json(b'{"n":0}')
+        self.receiver.recv(4096)
+
+        self.restart_queue()
+        msgs = [(b'{"n":%d}' % i, None) for i in range(3)]
+        results = api.send_msgs_bulk(msgs)
+        self.assertEqual([r["status"] for r in results], ["success"] * 3)
+        self.assertEqual(
+            [self.receiver.recv(4096) for _ in msgs],
+            [b"1:Wazuh-AWS:" + body for body, _ in msgs]
+        )
+
+    def fill_queue(self) -> int:
+        """Queue datagrams until a non-blocking send would block; return how many."""
+        queued = 0
+        while True:
+            try:
+                api._send_datagram(b"filler", socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return queued
+            queued += 1
+
+    def assert_timed_out_sends_keep_slot(self, semaphore_name, send):
+        """Time out sends on a full queue; the blocked thread must keep its slot."""
+        queued = self.fill_queue()
+
+        async def time_out_sends():
+            original_semaphore = getattr(api, semaphore_name)
+            semaphore = asyncio.Semaphore(1)
+            setattr(api, semaphore_name, semaphore)
+            try:
+                for _ in range(3):
+                    with self.assertRaises(asyncio.TimeoutError):
+                        await asyncio.wait_for(send(), 0.05)
+                    # The first send's thread is still blocked on the full queue
+                    self.assertTrue(semaphore.locked())
+            finally:
+                # Room in the queue lets blocked threads return
+                for _ in range(queued):
+                    self.receiver.recv(4096)
+                setattr(api, semaphore_name, original_semaphore)
+
+            for _ in range(100):
+                if not semaphore.locked():
+                    break
+                await asyncio.sleep(0.01)
+            self.assertFalse(semaphore.locked())
+
+        asyncio.run(time_out_sends())
+        self.assertEqual(self.receiver.recv(4096), b'1:Wazuh-AWS:{"n":1}')
+
+    def test_timed_out_bulk_send_keeps_its_slot(self):
+        self.assert_timed_out_sends_keep_slot(
+            "_batch_send_semaphore", lambda: api.send_msgs_bulk_async([(b'{"n":1}', None)])
+        )
+
+    def test_timed_out_async_send_keeps_its_slot(self):
+        self.assert_timed_out_sends_keep_slot(
+            "_ingest_send_semaphore", lambda: api.send_msg_json_async(b'{"n":1}')
+        )
+
+    def test_async_send_waits_for_room_in_full_queue(self):
+        queued = self.fill_queue()
+
+        async def send_while_full():
+            original_semaphore = api._ingest_send_semaphore
+            api._ingest_send_semaphore = asyncio.Semaphore(1)
+            try:
+                tasks = [asyncio.create_task(api.send_msg_json_async(b'{"n":%d}' % i)) for i in range(3)]
+                await asyncio.sleep(0.1)
+                # Only one waiting send holds a worker thread
+                self.assertTrue(api._ingest_send_semaphore.locked())
+                drain = threading.Thread(target=lambda: [self.receiver.recv(4096) for _ in range(queued)])
+                drain.start()
+                results = await asyncio.gather(*tasks)
+                drain.join()
+                return results
+            finally:
+                api._ingest_send_semaphore = original_semaphore
+
+        results = asyncio.run(send_while_full())
+        self.assertEqual([r["status"] for r in results], ["success"] * 3)
+        received = sorted(self.receiver.recv(4096) for _ in results)
+        self.assertEqual(received, [b'1:Wazuh-AWS:{"n":%d}' % i for i in range(3)])
+
+    def test_send_fails_when_queue_is_gone(self):
+        api.send_msg_json(b'{"n":1}')
+        self.receiver.close()
+        os.unlink(self.path)
+
+        result = api.send_msg_json(b'{"n":2}')
+        self.assertEqual(result, {"status": "error", "message": "Backend service unavailable"})
+        self.assertIsNone(api._wazuh_sock)
+
+
+if __name__ == "__main__":
+    unittest.main()